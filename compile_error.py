@@ -1,21 +1,49 @@
-import re
 from typing import Optional
 
 from dodona_command import Annotation, Message, MessageFormat
 
-_is_undefined_reference = r"\/usr\/bin\/ld: .*\n?\w+\.(?:h|cpp):\([\w\+\.]+\): undefined reference to `(?P<missing_reference>[^']*)'"
-_is_compile_error = r"[\/\w\.]+:(?P<line>\d+):(?P<column>\d+): error: (?P<message>.+)"
+try:
+    # google-re2 is a linear-time alternative to re for the patterns below
+    import re2 as _re
 
-def handle_compile_error(stderr_content:str, exit_code:Optional[int]=None):
+    # re2 reads patterns and input as UTF-8 by default, so invalid UTF-8 in cmake's stderr
+    # would change the matches. In Latin-1 mode every byte is one character, as with re's bytes patterns.
+    _re_options = _re.Options()
+    _re_options.encoding = _re.Options.Encoding.LATIN1
+except ImportError:
+    import re as _re
+
+    _re_options = None
+
+def _compile(pattern:bytes):
+    if _re_options is None:
+        return _re.compile(pattern)
+
+    return _re.compile(pattern, options=_re_options)
+
+_is_undefined_reference = rb"\/usr\/bin\/ld: .*\n?\w+\.(?:h|cpp):\([\w\+\.]+\): undefined reference to `(?P<missing_reference>[^']*)'"
+_is_compile_error = rb"[\/\w\.]+:(?P<line>\d+):(?P<column>\d+): error: (?P<message>.+)"
+
+# Multiline mode is set inline, since re2 does not accept the flags of the re module.
+# The patterns are bytes, so the raw stderr of cmake can be scanned without decoding it first.
+# re2 only accepts bytes group names for bytes patterns while re only accepts str names,
+# so groups are accessed by position.
+_undefined_reference_re = _compile(b"(?m)" + _is_undefined_reference)
+_compile_error_re = _compile(b"(?m)" + _is_compile_error)
+
+def handle_compile_error(stderr_content:bytes, exit_code:Optional[int]=None):
     """
-    Handles compile errors and link time errors on undefined references
+    Handles compile errors and link time errors on undefined references,
+    stderr_content is the raw (undecoded) stderr of cmake
     """
 
-    undefined_references = list(re.finditer(_is_undefined_reference, stderr_content, flags=re.MULTILINE))
-
-    if undefined_references:
-        missing_references = set(m.group("missing_reference") for m in undefined_references)
+    # Cheap substring checks first: the regexes can only match if these literals are present
+    if b"/usr/bin/ld: " in stderr_content:
+        missing_references = {m.group(1).decode("utf-8", errors="replace") for m in _undefined_reference_re.finditer(stderr_content)}
+    else:
+        missing_references = set()
 
+    if missing_references:
         with Message(
             description = "Could not find the following references:\n" + "\n".join([f" * `{m_ref}`" for m_ref in missing_references]),
             format = MessageFormat.MARKDOWN,
@@ -23,12 +51,14 @@ def handle_compile_error(stderr_content:str, exit_code:Optional[int]=None):
         ):
             return
     else:
-        compile_error_match = re.search(_is_compile_error, stderr_content, flags=re.MULTILINE)
+        if b": error: " in stderr_content:
+            compile_error_match = _compile_error_re.search(stderr_content)
+        else:
+            compile_error_match = None
 
         if compile_error_match:
-            line = compile_error_match.group("line")
-            column = compile_error_match.group("column")
-            error_message = compile_error_match.group("message")
+            line, column, error_message = compile_error_match.groups()
+            error_message = error_message.decode("utf-8", errors="replace")
 
             with Message(
                 description = error_message, format=MessageFormat.CODE
@@ -40,10 +70,7 @@ def handle_compile_error(stderr_content:str, exit_code:Optional[int]=None):
                 ):
                     return
     
-    error_message_md = "> ```\n" + ("\n".join(
-        "> " + line
-            for line in stderr_content.split("\n")
-    )) + "\n> ```"
+    error_message_md = "> ```\n> " + stderr_content.decode("utf-8", errors="replace").replace("\n", "\n> ") + "\n> ```"
 
     with Message(
         description = f"Failed to build solution.\nCmake returned exit code **{exit_code}**.\n{error_message_md}",
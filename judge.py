@@ -1,31 +1,76 @@
 from collections import Counter
-import json
+import functools
+import itertools
 import math
-from operator import itemgetter
 import os
-from pathlib import Path
+from pathlib import Path, PurePath
 import sys
 import tempfile
-import time
-from typing import Any, Optional, Tuple, Dict, Union
-from dodona_command import Judgement, MessageFormat, Tab, Context, TestCase, Test, Annotation, Message, ErrorType
+from typing import Any, List, NamedTuple, Optional, Set, Tuple, Dict, Union
+from dodona_command import Judgement, MessageFormat, Tab, Context, TestCase, Test, Annotation, Message, ErrorType, DodonaException
 import subprocess
 from helpers import tree
 
-def get_test_output_files(test_source_path:Path, evaluation_folder:Path, build_path:Path) -> Dict[str, Path]:
-    rel_path = test_source_path.relative_to(evaluation_folder)
+try:
+    # orjson is a faster drop-in for parsing lit's JSON report
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
 
-    return {
-        "stdout": build_path / "test" / rel_path.parent / "Output" / f"{test_source_path.name}.tmp.stdout",
-        "stderr": build_path / "test" / rel_path.parent / "Output" / f"{test_source_path.name}.tmp.stderr"
-    }
+def _cgroup_cpu_quota() -> Optional[float]:
+    # The CPU quota of the container (e.g. docker --cpus) in number of CPUs, or None if there is none.
+    # cgroup v2 exposes "<quota> <period>" in cpu.max, cgroup v1 uses two separate files.
+    try:
+        with open("/sys/fs/cgroup/cpu.max", "r") as f:
+            quota, period = f.read().split()
+    except (OSError, ValueError):
+        try:
+            with open("/sys/fs/cgroup/cpu/cpu.cfs_quota_us", "r") as f:
+                quota = f.read().strip()
+            with open("/sys/fs/cgroup/cpu/cpu.cfs_period_us", "r") as f:
+                period = f.read().strip()
+        except OSError:
+            return None
+
+    if quota in ("max", "-1"):
+        return None
+
+    try:
+        return int(quota) / int(period)
+    except (ValueError, ZeroDivisionError):
+        return None
+
+def _num_test_workers() -> int:
+    # os.cpu_count() reports the host's cores inside a container and sched_getaffinity only
+    # reflects cpusets, so the cgroup CPU quota is what actually bounds the judge. lit's timeouts
+    # are wall-clock, so running more tests than there are CPUs would turn slow tests into timeouts.
+    num_workers = len(os.sched_getaffinity(0))
+
+    cpu_quota = _cgroup_cpu_quota()
+    if cpu_quota is not None:
+        num_workers = min(num_workers, math.floor(cpu_quota))
+
+    return max(1, min(num_workers, 4))
+
+# Number of tests that lit runs at the same time
+_max_test_workers = _num_test_workers()
+
+@functools.lru_cache(maxsize=None)
+def get_test_output_files(test_source_path:Path, evaluation_folder:Path, build_path:Path) -> Tuple[Path, Path]:
+    # Returns the paths of the stdout and stderr files that lit generates for a test
+    output_folder = build_path / "test" / test_source_path.relative_to(evaluation_folder).parent / "Output"
+
+    return (
+        output_folder / f"{test_source_path.name}.tmp.stdout",
+        output_folder / f"{test_source_path.name}.tmp.stderr",
+    )
 
 def warn_unexpected_error(error_message:str):
     lightning_icon = "&#9889;"
 
     warning = f"{lightning_icon} **Your solution threw an unexpected error:**\n```\n{error_message}\n```"
 
-    warning = "\n".join(f"> {l}" for l in warning.split("\n"))
+    warning = "> " + warning.replace("\n", "\n> ")
 
     with Message(
         description = warning,
@@ -38,7 +83,7 @@ def warn_timeout(duration:float):
 
     warning = f"{stopwatch_icon} **Your solution timed out:** it took more than {duration:.1f} s"
 
-    warning = "\n".join(f"> {l}" for l in warning.split("\n"))
+    warning = "> " + warning.replace("\n", "\n> ")
 
     with Message(
         description = warning,
@@ -46,62 +91,133 @@ def warn_timeout(duration:float):
     ):
         return
 
-def _test_run_helper(test_source_path:Path, expected_output_path:Path, expected_error_path:Path, evaluation_folder:Path, build_path:Path) -> Dict[str, Any]:
-    if expected_output_path.exists():
-        with expected_output_path.open("r", errors="replace") as f:
-            expected_output = f.read()
+@functools.lru_cache(maxsize=1024)
+def _read_expected(path_str:str, mtime:float) -> str:
+    # The modification time is part of the cache key, so an updated file is read again
+    with open(path_str, "r", errors="replace") as f:
+        return f.read()
+
+def _read_generated(path:Path) -> str:
+    # A missing file (e.g. the test crashed before writing it) reads as empty
+    try:
+        with path.open("r", errors="replace") as f:
+            return f.read()
+    except FileNotFoundError:
+        return ""
+
+# lit result codes for which lit exits with a non-zero return code
+_lit_failure_codes = {"FAIL", "XPASS", "UNRESOLVED", "TIMEOUT"}
+
+def _read_lit_report(lit_target_paths:List[Path]) -> List[Dict[str, Any]]:
+    # Runs the given tests in a single lit invocation, using lit's own worker pool.
+    # A missing or unreadable report (e.g. because lit crashed) reads as no results.
+    with tempfile.NamedTemporaryFile("r+", suffix=".json") as tmp_lit_ouput_file:
+        subprocess.run(["lit", "-j", str(_max_test_workers), *(str(p) for p in lit_target_paths), "-o", tmp_lit_ouput_file.name], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+        tmp_lit_ouput_file.seek(0)
+        lit_output = tmp_lit_ouput_file.read()
+
+    try:
+        return json_loads(lit_output)["tests"]
+    except (ValueError, KeyError, TypeError):
+        return []
+
+def _match_lit_results(lit_tests:List[Dict[str, Any]], test_paths:Set[PurePath]) -> Dict[PurePath, Dict[str, Any]]:
+    # Test names look like "<suite> :: <path relative to the suite root>". test_paths are relative
+    # to the evaluation folder, which lies inside the suite root, so a test's path is the longest
+    # trailing part of its name that is in test_paths.
+    results = {}
+
+    for lit_test in lit_tests:
+        lit_test_parts = PurePath(lit_test["name"].split(" :: ", 1)[-1]).parts
+
+        for i in range(len(lit_test_parts)):
+            test_path = PurePath(*lit_test_parts[i:])
+
+            if test_path in test_paths:
+                results[test_path] = lit_test
+                break
+
+    return results
+
+def _run_lit_batch(test_source_paths:List[Path], evaluation_folder:Path, build_path:Path) -> Dict[PurePath, Dict[str, Any]]:
+    # Returns lit's result for every test, keyed by its path relative to evaluation_folder.
+    # The tests are passed to lit as explicit files, so they run regardless of the suffixes
+    # and excludes in the course's lit config.
+    test_paths = [f.relative_to(evaluation_folder) for f in test_source_paths]
+
+    if not test_paths:
+        return {}
+
+    results = _match_lit_results(_read_lit_report([build_path / "test" / p for p in test_paths]), set(test_paths))
+
+    for test_path in test_paths:
+        if test_path not in results:
+            # Retry a test that the batch did not report on by itself
+            results.update(_match_lit_results(_read_lit_report([build_path / "test" / test_path]), {test_path}))
+
+        if test_path not in results:
+            # This is a problem with the judge or the course, not with the submission
+            raise DodonaException(
+                _status_internal_error,
+                description = f"lit did not report a result for `{test_path}`",
+                format = MessageFormat.MARKDOWN,
+            )
+
+    return results
+
+class TestResult(NamedTuple):
+    correct: bool
+    status: str # "PASS", "FAIL" or "TIMEOUT"
+    duration: float
+    expected_output: Optional[str]
+    expected_error: Optional[str]
+    generated_output: Optional[str]
+    generated_error: Optional[str]
+
+def _test_run_helper(test_source_path:Path, lit_test:Dict[str, Any], expected_output_entry:Optional[os.DirEntry], expected_error_entry:Optional[os.DirEntry], evaluation_folder:Path, build_path:Path) -> TestResult:
+    # The expected files are passed as entries from a scandir of the test folder,
+    # so neither their existence nor their mtime needs a separate stat call
+    if expected_output_entry is not None:
+        expected_output = _read_expected(expected_output_entry.path, expected_output_entry.stat().st_mtime)
     else:
         expected_output = ""
     
-    if expected_error_path.exists():
-        with expected_error_path.open("r", errors="replace") as f:
-            expected_error = f.read()
+    if expected_error_entry is not None:
+        expected_error = _read_expected(expected_error_entry.path, expected_error_entry.stat().st_mtime)
     else:
         expected_error = ""
 
-    lit_target_path = build_path / "test" / (test_source_path.relative_to(evaluation_folder))
-    try:
-        tmp_lit_ouput_file = tempfile.NamedTemporaryFile(delete=False)
-
-        proc_rec = subprocess.run(["lit", str(lit_target_path), "-o", tmp_lit_ouput_file.name], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-
-        with open(tmp_lit_ouput_file.name, "r") as f:
-            lit_output_json = json.load(f)["tests"][0]
-    finally:
-        os.remove(tmp_lit_ouput_file.name)
-
-    is_correct = (proc_rec.returncode == 0)
-    test_status = lit_output_json["code"] # "PASS" -> is_correct == True, "TIMEOUT" or "FAIL" -> is_correct = False
-    test_duration = lit_output_json["elapsed"]
+    is_correct = (lit_test["code"] not in _lit_failure_codes)
+    test_status = lit_test["code"] # "PASS" -> is_correct == True, "TIMEOUT" or "FAIL" -> is_correct = False
+    test_duration = lit_test["elapsed"]
 
-    if lit_target_path.name.endswith(".custom.c"):
+    if test_source_path.name.endswith(".custom.c"):
         expected_output = None
-        return {
-            "correct":          is_correct,
-            "status":           test_status,
-            "duration":         test_duration,
-            "expected_output":  expected_output,
-            "expected_error":   None,
-            "generated_output": None,
-            "generated_error":  None,
-        }
+        return TestResult(
+            correct          = is_correct,
+            status           = test_status,
+            duration         = test_duration,
+            expected_output  = expected_output,
+            expected_error   = None,
+            generated_output = None,
+            generated_error  = None,
+        )
     else:
-        stdout_file_path, stderr_file_path = itemgetter("stdout", "stderr")(get_test_output_files(test_source_path, evaluation_folder, build_path))
+        stdout_file_path, stderr_file_path = get_test_output_files(test_source_path, evaluation_folder, build_path)
 
-        with stdout_file_path.open("r", errors="replace") as f:
-            generated_output = f.read()
-        with stderr_file_path.open("r", errors="replace") as f:
-            generated_error  = f.read()
+        generated_output = _read_generated(stdout_file_path)
+        generated_error  = _read_generated(stderr_file_path)
     
-        return {
-            "correct":          is_correct,
-            "status":           test_status,
-            "duration":         test_duration,
-            "expected_output":  expected_output,
-            "expected_error":   expected_error,
-            "generated_output": generated_output,
-            "generated_error":  generated_error,
-        }
+        return TestResult(
+            correct          = is_correct,
+            status           = test_status,
+            duration         = test_duration,
+            expected_output  = expected_output,
+            expected_error   = expected_error,
+            generated_output = generated_output,
+            generated_error  = generated_error,
+        )
 
 _status_correct = {
     "enum": ErrorType.CORRECT, 
@@ -113,35 +229,23 @@ _status_wrong = {
     "human": ErrorType.WRONG, # "wrong" is readable enough for humans
 }
 
-def run_test(test_source_path:Path, expected_output_path:Path, expected_error_path:Path, evaluation_folder:Path, build_path:Path) -> Counter:
-    (
-        is_correct,
-        test_status,
-        test_duration,
-        expected_output,
-        expected_error,
-        generated_output,
-        generated_error,
-    ) = itemgetter(
-        "correct",
-        "status",
-        "duration",
-        "expected_output",
-        "expected_error",
-        "generated_output",
-        "generated_error"
-    )(_test_run_helper(test_source_path, expected_output_path, expected_error_path, evaluation_folder=evaluation_folder, build_path=build_path))
+_status_internal_error = {
+    "enum": ErrorType.INTERNAL_ERROR,
+    "human": ErrorType.INTERNAL_ERROR,
+}
 
+def run_test(test_source_path:Path, test_result:TestResult, evaluation_folder:Path) -> Dict[str, int]:
     is_custom_test = test_source_path.name.endswith(".custom.c")
-    did_timeout = (test_status == "TIMEOUT")
+    did_timeout = (test_result.status == "TIMEOUT")
 
     # --- Test file to markdown ---
     with test_source_path.open("r", encoding="utf-8") as f:
         short_file_path_str = str(test_source_path.relative_to(evaluation_folder))
 
-        test_code = f.readlines()
+        # only read as much of the file as can be shown
+        test_code = list(itertools.islice(f, 10))
 
-        if len(test_code) > 10:
+        if f.readline():
             # do not show more than 10 lines of code
             test_code = test_code[:9] + ["... // Remainder of code omitted"]
         
@@ -151,47 +255,47 @@ def run_test(test_source_path:Path, expected_output_path:Path, expected_error_pa
     
     if False: #is_custom_test:
         with Test(description={"description": f" &#x1F4C4; {short_file_path_str}\n{test_code_md}", "format": MessageFormat.MARKDOWN}, expected="") as test:
-            if is_correct:
+            if test_result.correct:
                 test.status = _status_correct
             else:
                 test.status = _status_wrong
             test.generated = ""
 
             if did_timeout:
-                warn_timeout(test_duration)
+                warn_timeout(test_result.duration)
     else:
         # --- Get expected output/error ---
 
-        if expected_error:
-            expected = expected_error
-            generated = generated_error
+        if test_result.expected_error:
+            expected = test_result.expected_error
+            generated = test_result.generated_error
             unexpected_error = False
         else:
-            expected = expected_output
-            generated = generated_output
+            expected = test_result.expected_output
+            generated = test_result.generated_output
             
-            unexpected_error = bool(generated_error)
+            unexpected_error = bool(test_result.generated_error)
         
         # --- Output test info ---
 
         with Test(description={"description": f" &#x1F4C4; {short_file_path_str}\n{test_code_md}", "format": MessageFormat.MARKDOWN}, expected=expected) as test:
-            if is_correct:
+            if test_result.correct:
                 test.status = _status_correct
             else:
                 test.status = _status_wrong
             test.generated = generated
 
             if unexpected_error:
-                warn_unexpected_error(generated_error)
+                warn_unexpected_error(test_result.generated_error)
             elif did_timeout:
-                warn_timeout(test_duration)
+                warn_timeout(test_result.duration)
     
     # --- Help counting the total number of (in)correct tests
 
-    return Counter({
-        "correct": int(is_correct),
+    return {
+        "correct": int(test_result.correct),
         "total": 1
-    })
+    }
 
 def success_bar(num_success:int, num_total:int, width:int=20):
     success_rate = num_success/num_total
@@ -202,17 +306,10 @@ def success_bar(num_success:int, num_total:int, width:int=20):
 def run_hidden_tests(hidden_tests_folder:Path, evaluation_folder:Path, build_path:Path) -> Counter:
     all_source_files = [f for f in hidden_tests_folder.glob("**/*.c")]
 
-    num_success = 0
-    num_tests = 0
-
-    for test_source_path in all_source_files:
-        expected_output_path = hidden_tests_folder / f"{test_source_path.name}.stdout"
-        expected_error_path = hidden_tests_folder / f"{test_source_path.name}.stderr"
-
-        is_correct = _test_run_helper(test_source_path, expected_output_path, expected_error_path, evaluation_folder=evaluation_folder, build_path=build_path)["correct"]
+    lit_results = _run_lit_batch(all_source_files, evaluation_folder=evaluation_folder, build_path=build_path)
 
-        num_success += is_correct
-        num_tests += 1
+    num_success = sum(lit_test["code"] not in _lit_failure_codes for lit_test in lit_results.values())
+    num_tests = len(all_source_files)
 
     test_case_message = {"description": f"##### Hidden tests: {success_bar(num_success, num_tests)} {num_success}/{num_tests} correct", "format": MessageFormat.MARKDOWN}
 
@@ -225,6 +322,7 @@ def run_hidden_tests(hidden_tests_folder:Path, evaluation_folder:Path, build_pat
         "total": num_tests
     })
 
+@functools.lru_cache(maxsize=None)
 def folder_path_to_title(folder_path:Path) -> str:
     return folder_path.name.replace("_", " ").replace("-", " ").capitalize()
 
@@ -234,14 +332,23 @@ def run_test_case(test_case_folder_path:Path, evaluation_folder:Path, build_path
     test_case_name = {"description": f"##### {folder_path_to_title(test_case_folder_path)}", "format": MessageFormat.MARKDOWN}
 
     with TestCase(test_case_name) as test_case:
-        all_source_files = test_case_folder_path.glob("*.c")
-
-        for test_source_path in all_source_files:
+        all_source_files = list(test_case_folder_path.glob("*.c"))
+        present_files = {entry.name: entry for entry in os.scandir(test_case_folder_path)}
 
-            expected_output_path = test_case_folder_path / f"{test_source_path.name}.stdout"
-            expected_error_path = test_case_folder_path / f"{test_source_path.name}.stderr"
+        # All tests of the test case run in a single lit invocation, the Dodona output is emitted in order afterwards
+        lit_results = _run_lit_batch(all_source_files, evaluation_folder=evaluation_folder, build_path=build_path)
 
-            res += run_test(test_source_path, expected_output_path, expected_error_path, evaluation_folder=evaluation_folder, build_path=build_path)
+        for test_source_path in all_source_files:
+            test_result = _test_run_helper(
+                test_source_path,
+                lit_results[test_source_path.relative_to(evaluation_folder)],
+                present_files.get(f"{test_source_path.name}.stdout"),
+                present_files.get(f"{test_source_path.name}.stderr"),
+                evaluation_folder=evaluation_folder,
+                build_path=build_path
+            )
+
+            res.update(run_test(test_source_path, test_result, evaluation_folder=evaluation_folder))
     
     return res
 
@@ -255,10 +362,39 @@ def test_submission(evaluation_folder:Path, build_path:Path) -> Counter:
     for folder in tab_folders:
         if folder.name == "grading":
             continue
-        res += create_tab(folder, evaluation_folder=evaluation_folder, build_path=build_path)
+        res.update(create_tab(folder, evaluation_folder=evaluation_folder, build_path=build_path))
 
     return res
 
+class FolderScan(NamedTuple):
+    # All folders and c files below a folder, as paths relative to that folder
+    folders: List[PurePath]
+    c_files: List[PurePath]
+
+    def sub_folder_names(self) -> List[str]:
+        return [f.name for f in self.folders if len(f.parts) == 1]
+
+    def child(self, name:str) -> "FolderScan":
+        # The part of this scan below the direct sub folder called name, relative to that sub folder
+        return FolderScan(
+            folders = [PurePath(*f.parts[1:]) for f in self.folders if len(f.parts) > 1 and f.parts[0] == name],
+            c_files = [PurePath(*f.parts[1:]) for f in self.c_files if len(f.parts) > 1 and f.parts[0] == name],
+        )
+
+def _scan_folder(folder:Path) -> FolderScan:
+    # A single walk over folder. The contexts of a tab use slices of the tab's scan,
+    # so every tab is walked only once.
+    folders = []
+    c_files = []
+
+    for root, dir_names, file_names in os.walk(folder):
+        rel_root = PurePath(root).relative_to(folder)
+
+        folders.extend(rel_root / name for name in dir_names)
+        c_files.extend(rel_root / name for name in file_names if name.endswith(".c"))
+
+    return FolderScan(folders=folders, c_files=c_files)
+
 def create_tab(tab_folder:Path, evaluation_folder:Path, build_path:Path) -> Counter:
     # A tab corresponds to a top-level rubric, like "Literals"
     # A tab might have one or more contexts, which correspond to sub-rubrics 
@@ -266,7 +402,11 @@ def create_tab(tab_folder:Path, evaluation_folder:Path, build_path:Path) -> Coun
     # If there are no sub-rubrics, then a dummy-context is created to hold all
     # testcases for this tab
 
-    is_grading_only = (set(tab_folder.glob("**/*.c")) == set(tab_folder.glob("grading/**/*.c")))
+    folder_scan = _scan_folder(tab_folder)
+    sub_folder_names = folder_scan.sub_folder_names()
+    c_files = folder_scan.c_files
+
+    is_grading_only = all(len(f.parts) > 1 and f.parts[0] == "grading" for f in c_files)
 
     if is_grading_only:
         return Counter()
@@ -274,24 +414,24 @@ def create_tab(tab_folder:Path, evaluation_folder:Path, build_path:Path) -> Coun
     # If there are sub_rubrics then the tab_folder contains a folder for each 
     # sub-rubric, which contain folders for all test cases, which each contain
     # c files for each test
-    has_sub_rubrics = bool(list(tab_folder.glob("*/**/*.c"))) and not all(f.name in ("hidden", "grading") for f in tab_folder.iterdir() if f.is_dir())
+    has_sub_rubrics = any(len(f.parts) > 1 for f in c_files) and not all(name in ("hidden", "grading") for name in sub_folder_names)
 
     res = Counter()
 
     with Tab(title=folder_path_to_title(tab_folder)) as tab:
         if not has_sub_rubrics:
-            res += create_context(tab_folder, evaluation_folder=evaluation_folder, build_path=build_path, is_dummy=True) # dummy context
+            res.update(create_context(tab_folder, folder_scan, evaluation_folder=evaluation_folder, build_path=build_path, is_dummy=True)) # dummy context
         else:
-            context_folders = [item for item in tab_folder.glob("*") if item.is_dir()]
-            for folder in context_folders:
-                res += create_context(folder, evaluation_folder=evaluation_folder, build_path=build_path)
+            for name in sub_folder_names:
+                res.update(create_context(tab_folder / name, folder_scan.child(name), evaluation_folder=evaluation_folder, build_path=build_path))
         
         num_incorrect = res["total"] - res["correct"]
         tab.badgeCount = num_incorrect
     
     return res
 
-def create_context(context_folder:Path, evaluation_folder:Path, build_path:Path, is_dummy:bool=False) -> Counter:
+def create_context(context_folder:Path, folder_scan:FolderScan, evaluation_folder:Path, build_path:Path, is_dummy:bool=False) -> Counter:
+    # folder_scan covers context_folder, it is taken from the scan of the tab
     res = Counter()
 
     if not is_dummy:
@@ -305,23 +445,25 @@ def create_context(context_folder:Path, evaluation_folder:Path, build_path:Path,
     else:
         ctx_kwargs = {}
 
-    has_sub_folders = bool(list(context_folder.glob("*/**/*.c"))) and not all(f.name == "hidden" for f in context_folder.iterdir() if f.is_dir())
+    sub_folder_names = folder_scan.sub_folder_names()
+
+    has_sub_folders = any(len(f.parts) > 1 for f in folder_scan.c_files) and not all(name == "hidden" for name in sub_folder_names)
 
     with Context(**ctx_kwargs) as ctx:
         if not has_sub_folders:
-            res += run_test_case(context_folder, evaluation_folder=evaluation_folder, build_path=build_path)
+            res.update(run_test_case(context_folder, evaluation_folder=evaluation_folder, build_path=build_path))
             if (context_folder / "hidden").exists():
-                res += run_hidden_tests(context_folder / "hidden", evaluation_folder=evaluation_folder, build_path=build_path)
+                res.update(run_hidden_tests(context_folder / "hidden", evaluation_folder=evaluation_folder, build_path=build_path))
         else:
-            test_case_folders = [item for item in context_folder.glob("*") if item.is_dir()]
+            test_case_folders = [context_folder / name for name in sub_folder_names]
             
             for folder in test_case_folders:
                 if folder.name in ("hidden", "grading"):
                     continue # We want to run the hidden tests last
                 else:
-                    res += run_test_case(folder, evaluation_folder=evaluation_folder, build_path=build_path)
+                    res.update(run_test_case(folder, evaluation_folder=evaluation_folder, build_path=build_path))
             
             if (context_folder / "hidden").exists():
-                res += run_hidden_tests(context_folder / "hidden", evaluation_folder=evaluation_folder, build_path=build_path)
+                res.update(run_hidden_tests(context_folder / "hidden", evaluation_folder=evaluation_folder, build_path=build_path))
     
     return res
\ No newline at end of file